@@ -0,0 +1,66 @@
+"""Default aiohttp session shared by PoolCopilot clients."""
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+from typing import Any
+
+from aiohttp import connector as aiohttp_connector
+from aiohttp.client import ClientSession
+from aiohttp.connector import TCPConnector
+
+
+@dataclass
+class _SharedSession:
+    """A shared session and the number of clients using it."""
+
+    session: ClientSession
+    refcount: int = 0
+
+
+# Sessions only work on the loop that created them, so one is kept per loop
+_shared: dict[asyncio.AbstractEventLoop, _SharedSession] = {}
+
+
+def create_session(**kwargs: Any) -> ClientSession:
+    """Create a session with a connection pool tuned for the PoolCopilot API."""
+    connector = TCPConnector(
+        limit=32,
+        limit_per_host=8,
+        keepalive_timeout=75,
+        ttl_dns_cache=300,
+        # Only needed on Python versions that leak closed SSL transports;
+        # newer aiohttp warns when it is enabled needlessly
+        enable_cleanup_closed=getattr(aiohttp_connector, "NEEDS_CLEANUP_CLOSED", True),
+    )
+    return ClientSession(connector=connector, **kwargs)
+
+
+def get_default_session() -> ClientSession:
+    """Return the default session for the running loop, creating it if needed.
+
+    Every call must be paired with a call to `release_default_session`.
+    """
+    for loop in [loop for loop in _shared if loop.is_closed()]:
+        # Drop sessions left behind by clients that were never closed
+        del _shared[loop]
+
+    loop = asyncio.get_running_loop()
+    shared = _shared.get(loop)
+    if shared is None or shared.session.closed:
+        shared = _shared[loop] = _SharedSession(create_session())
+    shared.refcount += 1
+    return shared.session
+
+
+async def release_default_session(session: ClientSession) -> None:
+    """Release a default session, closing it with its last user."""
+    loop = asyncio.get_running_loop()
+    shared = _shared.get(loop)
+    if shared is None or shared.session is not session:
+        # Session was already closed and replaced; nothing to release
+        return
+    shared.refcount -= 1
+    if shared.refcount <= 0:
+        del _shared[loop]
+        await session.close()
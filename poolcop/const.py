@@ -2,5 +2,23 @@
 from importlib import metadata
 from typing import Final
 
+from yarl import URL
+
 API_HOST: Final = "poolcopilot.com"
 USER_AGENT: Final = f"python-poolcop/{metadata.version(__package__)}"
+BASE_URL: Final = URL.build(scheme="https", host=API_HOST, path="/api/v1/")
+
+CONNECT_TIMEOUT: Final = 5.0
+# Seconds a new token is trusted beyond the stale window until the API
+# reports its actual expiry
+TOKEN_PROVISIONAL_TTL: Final = 60.0
+# Transient failures are retried with full-jitter exponential backoff
+RETRY_STATUSES: Final = frozenset({429, 502, 503, 504})
+# Statuses on which the server did not act on the request
+RETRY_STATUSES_UNSAFE: Final = frozenset({429, 503})
+RETRY_BACKOFF_BASE: Final = 0.5
+RETRY_BACKOFF_MAX: Final = 30.0
+# Longest server-requested delay (seconds) waited out before giving up
+RETRY_AFTER_MAX: Final = 60.0
+# Bytes of an unexpected response body kept for diagnostics
+ERROR_BODY_LIMIT: Final = 2048
@@ -2,18 +2,53 @@
 from __future__ import annotations
 
 import asyncio
+import contextlib
+import random
 import socket
 import time
-from dataclasses import dataclass
-from typing import Any, cast
+from collections.abc import Awaitable, Callable, Iterable
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Any, ClassVar, cast
+from urllib.parse import urlencode
 
-import async_timeout
 from http import HTTPStatus
-from aiohttp.client import ClientError, ClientResponseError, ClientSession
-from aiohttp.hdrs import METH_GET, METH_POST
+from aiohttp.client import (
+    ClientConnectionError,
+    ClientConnectorError,
+    ClientError,
+    ClientResponse,
+    ClientResponseError,
+    ClientSession,
+    ClientTimeout,
+)
+from aiohttp.hdrs import (
+    METH_GET,
+    METH_HEAD,
+    METH_OPTIONS,
+    METH_POST,
+    RETRY_AFTER,
+)
 from yarl import URL
 
-from .const import API_HOST, USER_AGENT
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from ._session import create_session, get_default_session, release_default_session
+from .const import (
+    BASE_URL,
+    CONNECT_TIMEOUT,
+    ERROR_BODY_LIMIT,
+    RETRY_AFTER_MAX,
+    RETRY_BACKOFF_BASE,
+    RETRY_BACKOFF_MAX,
+    RETRY_STATUSES,
+    RETRY_STATUSES_UNSAFE,
+    TOKEN_PROVISIONAL_TTL,
+    USER_AGENT,
+)
 from .exceptions import (
     PoolCopilotConnectionError,
     PoolCopilotInvalidKeyError,
@@ -22,62 +57,176 @@ from .exceptions import (
 )
 
 
-@dataclass
+def _parse_retry_after(value: str | None) -> float | None:
+    """Parse a Retry-After header, in seconds or as an HTTP-date."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isascii() and value.isdigit():
+        # delta-seconds is 1*DIGIT; float() would also take "inf" or "1e9"
+        return float(int(value))
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+@dataclass(slots=True, repr=False, eq=False, kw_only=True)
 class PoolCopilot:
     """Main class for handling data fetching from PoolCopilot."""
 
+    _PUMP_URIS: ClassVar[tuple[str, ...]] = (
+        "command/pump/1",
+        "command/pump/2",
+        "command/pump/3",
+    )
+    _URL_CACHE: ClassVar[dict[str, URL]] = {
+        uri: BASE_URL / uri
+        for uri in (
+            "token",
+            "status",
+            "command/pump",
+            *_PUMP_URIS,
+            "command/clear_alarm",
+        )
+    }
+    _static_headers: ClassVar[dict[str, str]] = {
+        "Accept": "application/json",
+        "User-Agent": USER_AGENT,
+    }
+    _token_headers: ClassVar[dict[str, str]] = {
+        **_static_headers,
+        "Content-Type": "application/x-www-form-urlencoded",
+    }
+
     api_key: str | None = None
     request_timeout: float = 10.0
+    max_retries: int = 4
+    max_concurrency: int = 8
+    rate_limit_per_minute: int | None = None
+    status_ttl: float = 0.0
     session: ClientSession | None = None
-
-    _close_session: bool = False
-    _token: str = None
-    _token_expire: int = 0
-    _token_limit: int | None = None
-    _poolcop_id: int | None = None
+    shared_session: bool = True
+
+    _close_session: bool = field(init=False, default=False)
+    _release_session: bool = field(init=False, default=False)
+    _token: str | None = field(init=False, default=None)
+    _token_expire: float = field(init=False, default=0.0)
+    _token_limit: int | None = field(init=False, default=None)
+    _poolcop_id: int | None = field(init=False, default=None)
+    _rate_limit_until: float = field(init=False, default=0.0)
+    _next_request_at: float = field(init=False, default=0.0)
+    _stale_window: float = field(init=False, default=180.0)
+    _refresh_task: asyncio.Task[None] | None = field(init=False, default=None)
+    _auth_lock: asyncio.Lock = field(init=False, default_factory=asyncio.Lock)
+    _status_cache: tuple[float, dict[str, Any]] | None = field(
+        init=False, default=None
+    )
+    _status_lock: asyncio.Lock = field(init=False, default_factory=asyncio.Lock)
+    _status_generation: int = field(init=False, default=0)
+    _auth_headers: dict[str, str] = field(init=False)
+    _auth_body: bytes = field(init=False)
+    _auth_body_key: str | None = field(init=False)
+    _semaphore: asyncio.Semaphore = field(init=False)
+    _timeout: ClientTimeout = field(init=False)
+
+    def __post_init__(self) -> None:
+        """Initialize the request headers and body, timeouts and concurrency."""
+        self._auth_headers = self._static_headers
+        self._encode_auth_body()
+        self._timeout = ClientTimeout(
+            total=self.request_timeout,
+            connect=CONNECT_TIMEOUT,
+            sock_read=self.request_timeout,
+        )
+        if self.max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
 
     @property
     def poolcop_id(self):
         """Primary PoolCop Identifier"""
         return self._poolcop_id
 
-    def _build_url(self, uri):
-        return URL.build(scheme="https", host=API_HOST, path=f"/api/v1/{uri}")
+    def _build_url(self, uri: str) -> URL:
+        return self._URL_CACHE.get(uri) or BASE_URL / uri
 
-    def _headers(self):
-        headers = {
-            "Accept": "application/json",
-            "User-Agent": USER_AGENT,
-        }
-        if self._token is not None:
-            headers["PoolCop-Token"] = self._token
-        return headers
+    def _encode_auth_body(self) -> None:
+        self._auth_body_key = self.api_key
+        self._auth_body = urlencode({"APIKEY": self.api_key or ""}).encode()
+
+    def _set_token(self, token: str | None) -> None:
+        self._token = token
+        self._token_limit = None
+        if token is None:
+            self._auth_headers = self._static_headers
+        else:
+            self._auth_headers = {**self._static_headers, "PoolCop-Token": token}
+            # Expiry of the new token is only known from the next response;
+            # until then it goes stale shortly, so a refresh follows if no
+            # response arrives
+            self._token_expire = (
+                time.monotonic() + self._stale_window + TOKEN_PROVISIONAL_TTL
+            )
 
     async def _authenticate(self) -> None:
-        """Authenticate and store a token"""
+        """Authenticate and store a token.
 
-        expire_in = self._token_expire - time.time()
-        if self._token is not None and expire_in > 0:
+        A token close to expiry is refreshed in the background while the
+        current one is still used; only an expired token blocks the caller.
+        """
+
+        expire_in = self._token_expire - time.monotonic()
+        if self._token is not None and expire_in > self._stale_window:
             # Valid token
             return
 
-        self._token = None
-        self._token_limit = None
+        if self._token is not None and expire_in > 0:
+            # Stale token, still valid while a new one is fetched
+            if self._refresh_task is None or self._refresh_task.done():
+                self._refresh_task = asyncio.create_task(self._background_refresh())
+            return
+
+        # Only one refresh at a time; waiters reuse the token it fetched
+        token = self._token
+        async with self._auth_lock:
+            if self._token is not None and (
+                self._token is not token or self._token_expire - time.monotonic() > 0
+            ):
+                return
+            await self._do_refresh()
+
+    async def _background_refresh(self) -> None:
+        """Refresh the token, forcing a blocking refresh on failure."""
         try:
-            async with async_timeout.timeout(self.request_timeout):
-                response = await self.session.post(
-                    self._build_url("token"),
-                    data={"APIKEY": self.api_key},
-                    headers=self._headers(),
-                    ssl=True,
-                )
-                response.raise_for_status()
+            async with self._auth_lock:
+                await self._do_refresh()
+        except PoolCopilotError:
+            self._token_expire = 0.0
+
+    async def _do_refresh(self) -> None:
+        """Request a new token from the API."""
+        if self.api_key != self._auth_body_key:
+            # api_key was reassigned since the body was encoded
+            self._encode_auth_body()
+        try:
+            response = await self.session.post(
+                self._build_url("token"),
+                data=self._auth_body,
+                headers=self._token_headers,
+                timeout=self._timeout,
+                ssl=True,
+            )
+            response.raise_for_status()
+            body = await response.read()
         except asyncio.TimeoutError as exception:
             raise PoolCopilotConnectionError(
                 "Timeout occurred while connecting to the API."
             ) from exception
         except ClientResponseError as exception:
             if exception.code == HTTPStatus.FORBIDDEN:
+                self._set_token(None)
                 raise PoolCopilotInvalidKeyError(
                     "Could not authenticate with the provided API key."
                 ) from exception
@@ -89,9 +238,15 @@ class PoolCopilot:
                 "Error occurred while communicating with the API."
             ) from exception
 
-        data = await response.json()
+        msg = "Unexpected token response from the PoolCopilot API"
+        try:
+            data = json_loads(body)
+        except ValueError as exception:
+            raise PoolCopilotError(msg) from exception
+        if not isinstance(data, dict):
+            raise PoolCopilotError(msg)
 
-        self._token = data.get("token", None)
+        self._set_token(data.get("token", None))
         if self._token is None:
             raise PoolCopilotInvalidKeyError(
                 "Could not authenticate with the provided API key."
@@ -100,7 +255,11 @@ class PoolCopilot:
 
     def _parse_token(self, api_token):
         self._token_limit = int(api_token.get("max_limit", 0))
-        self._token_expire = int(api_token.get("expire", 0))
+        # The API returns an epoch timestamp; rebase it onto the monotonic
+        # clock so wall-clock adjustments do not affect token expiry
+        self._token_expire = (
+            int(api_token.get("expire", 0)) - time.time() + time.monotonic()
+        )
         self._poolcop_id = api_token.get("poolcop_id", self._poolcop_id)
 
     async def _request(
@@ -132,53 +291,172 @@ class PoolCopilot:
         """
 
         if self.session is None:
-            self.session = ClientSession()
-            self._close_session = True
+            if self.shared_session:
+                self.session = get_default_session()
+                self._release_session = True
+            else:
+                self.session = create_session(timeout=self._timeout)
+                self._close_session = True
 
         await self._authenticate()
 
         if self._token_limit == 0:
             raise PoolCopilotRateLimitError("Rate limit hit")
 
-        try:
-            async with async_timeout.timeout(self.request_timeout):
-                response = await self.session.request(
-                    method,
-                    self._build_url(uri),
-                    headers=self._headers(),
-                    ssl=True,
+        auth_headers = self._auth_headers
+        async with self._semaphore:
+            response = await self._send(
+                method,
+                self._build_url(uri),
+                headers=auth_headers,
+                timeout=self._timeout,
+            )
+            if response.status >= HTTPStatus.BAD_REQUEST:
+                response.release()
+                if response.status == HTTPStatus.TOO_MANY_REQUESTS:
+                    raise PoolCopilotRateLimitError("Rate limit hit")
+                if response.status in {
+                    HTTPStatus.UNAUTHORIZED,
+                    HTTPStatus.FORBIDDEN,
+                } and (auth_headers is self._auth_headers):
+                    # Token rejected; fetch a new one on the next request
+                    self._set_token(None)
+                msg = "Error occurred while communicating with the API."
+                raise PoolCopilotConnectionError(
+                    msg,
+                    {"status": response.status, "reason": response.reason},
                 )
-                response.raise_for_status()
-        except asyncio.TimeoutError as exception:
-            msg = "Timeout occurred while connecting to the API."
-            raise PoolCopilotConnectionError(
-                msg,
-            ) from exception
-        except (ClientError, socket.gaierror) as exception:
-            msg = "Error occurred while communicating with the API."
-            raise PoolCopilotConnectionError(
-                msg,
-            ) from exception
 
-        content_type = response.headers.get("Content-Type", "")
-        if "application/json" not in content_type:
-            text = await response.text()
-            msg = "Unexpected content type response from the PoolCopilot API"
-            raise PoolCopilotError(
-                msg,
-                {"Content-Type": content_type, "response": text},
-            )
+            if response.content_type != "application/json":
+                # read() returns whatever is buffered; read one byte past the
+                # limit to know whether the body was cut short
+                try:
+                    raw = await response.content.readexactly(ERROR_BODY_LIMIT + 1)
+                except asyncio.IncompleteReadError as exception:
+                    raw = exception.partial
+                response.release()
+                text = raw[:ERROR_BODY_LIMIT].decode(
+                    response.charset or "utf-8", errors="replace"
+                )
+                msg = "Unexpected content type response from the PoolCopilot API"
+                raise PoolCopilotError(
+                    msg,
+                    {
+                        "Content-Type": response.content_type,
+                        "response": text,
+                        "truncated": len(raw) > ERROR_BODY_LIMIT,
+                    },
+                )
 
-        data = cast(dict[str, Any], await response.json())
-        self._parse_token(data.get("api_token", {}))
-        return data
+            data = cast(dict[str, Any], json_loads(await response.read()))
+            if auth_headers is self._auth_headers:
+                # Skip details of a token replaced while this request ran
+                self._parse_token(data.get("api_token", {}))
+            return data
+
+    async def _pace(self) -> None:
+        """Space out requests to stay within ``rate_limit_per_minute``."""
+        if not self.rate_limit_per_minute:
+            return
+        now = time.monotonic()
+        slot = max(now, self._next_request_at)
+        self._next_request_at = slot + 60 / self.rate_limit_per_minute
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _send(self, method: str, url: URL, **kwargs: Any) -> ClientResponse:
+        """Send a request, retrying transient failures.
+
+        Timeouts, connection errors and 429/5xx responses are retried up to
+        ``max_retries`` times with full-jitter exponential backoff, or after
+        the delay the server asked for in ``Retry-After``. Requests that are
+        not idempotent are only retried when the server cannot have acted on
+        them. Any other response is returned to the caller as is.
+
+        Raises
+        ------
+            PoolCopilotConnectionError: The request kept failing.
+            PoolCopilotRateLimitError: The server asked to back off for
+                longer than we are willing to wait.
+        """
+        idempotent = method in {METH_GET, METH_HEAD, METH_OPTIONS}
+        retry_statuses = RETRY_STATUSES if idempotent else RETRY_STATUSES_UNSAFE
+        retry_errors = ClientConnectionError if idempotent else ClientConnectorError
+
+        attempt = 0
+        while True:
+            # Wait out a server-requested back-off shared by all callers
+            delay = self._rate_limit_until - time.monotonic()
+            if delay > 0:
+                if delay > RETRY_AFTER_MAX:
+                    raise PoolCopilotRateLimitError("Rate limit hit")
+                await asyncio.sleep(delay)
+            await self._pace()
+
+            retry_after = None
+            try:
+                response = await self.session.request(method, url, ssl=True, **kwargs)
+            except asyncio.TimeoutError as exception:
+                if not idempotent or attempt >= self.max_retries:
+                    msg = "Timeout occurred while connecting to the API."
+                    raise PoolCopilotConnectionError(
+                        msg,
+                    ) from exception
+            except (ClientError, socket.gaierror) as exception:
+                if not isinstance(exception, retry_errors) or (
+                    attempt >= self.max_retries
+                ):
+                    msg = "Error occurred while communicating with the API."
+                    raise PoolCopilotConnectionError(
+                        msg,
+                    ) from exception
+            else:
+                if response.status in {
+                    HTTPStatus.TOO_MANY_REQUESTS,
+                    HTTPStatus.SERVICE_UNAVAILABLE,
+                }:
+                    retry_after = _parse_retry_after(response.headers.get(RETRY_AFTER))
+                    if retry_after is not None:
+                        self._rate_limit_until = max(
+                            self._rate_limit_until, time.monotonic() + retry_after
+                        )
+                if response.status not in retry_statuses or (
+                    attempt >= self.max_retries
+                ):
+                    return response
+                response.release()
+
+            attempt += 1
+            if retry_after is not None:
+                continue
+            await asyncio.sleep(
+                random.uniform(
+                    0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempt - 1))
+                )
+            )
 
     async def status(self) -> dict[str, Any]:
-        """Get PoolCop status."""
-        data = await self._request(
-            "status",
-        )
-        return data
+        """Get PoolCop status.
+
+        With ``status_ttl`` set, a status fetched less than that many seconds
+        ago is returned without contacting the API.
+        """
+        if self.status_ttl <= 0:
+            return await self._request("status")
+
+        async with self._status_lock:
+            if self._status_cache is not None:
+                fetched, data = self._status_cache
+                if time.monotonic() - fetched < self.status_ttl:
+                    return data
+            generation = self._status_generation
+            data = await self._request(
+                "status",
+            )
+            if generation == self._status_generation:
+                # Not cached if a command was sent while this was fetched
+                self._status_cache = (time.monotonic(), data)
+            return data
 
     async def alarm_history(self, offset: int = 0) -> dict[str, Any]:
         """Get PoolCop alarm history."""
@@ -187,34 +465,84 @@ class PoolCopilot:
         )
         return data
 
+    async def alarm_history_pages(
+        self, offsets: Iterable[int], *, concurrency: int = 5
+    ) -> list[dict[str, Any]]:
+        """Get several pages of PoolCop alarm history concurrently."""
+        return await self._gather_pages(self.alarm_history, offsets, concurrency)
+
     async def command_history(self, offset: int = 0) -> dict[str, Any]:
         """Get PoolCop command history."""
         return await self._request(f"history/commands/{offset}")
 
+    async def command_history_pages(
+        self, offsets: Iterable[int], *, concurrency: int = 5
+    ) -> list[dict[str, Any]]:
+        """Get several pages of PoolCop command history concurrently."""
+        return await self._gather_pages(self.command_history, offsets, concurrency)
+
+    async def _gather_pages(
+        self,
+        fetch: Callable[[int], Awaitable[dict[str, Any]]],
+        offsets: Iterable[int],
+        concurrency: int,
+    ) -> list[dict[str, Any]]:
+        """Fetch pages for the given offsets, at most ``concurrency`` at a time.
+
+        Requests are additionally bounded by ``max_concurrency``. Pages are
+        returned in the order of ``offsets``.
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch_page(offset: int) -> dict[str, Any]:
+            async with semaphore:
+                return await fetch(offset)
+
+        return await asyncio.gather(*(fetch_page(offset) for offset in offsets))
+
     async def toggle_pump(self) -> dict[str, Any]:
         """Toggle pump on/off."""
-        return await self._request("command/pump", method=METH_POST)
+        return await self._command("command/pump")
 
     async def set_pump_speed(self, speed: int) -> dict[str, Any]:
         """Set pump to a certain speed."""
-        assert speed in {1, 2, 3}
-        return await self._request(f"command/pump/{speed}", method=METH_POST)
+        if speed not in (1, 2, 3):
+            raise ValueError(f"Invalid pump speed {speed!r}, expected 1, 2 or 3")
+        return await self._command(self._PUMP_URIS[speed - 1])
 
     async def toggle_aux(self, aux_id: int) -> dict[str, Any]:
         """Toggle aux on/off."""
-        return await self._request("command/aux/{aux_id}", method=METH_POST)
+        return await self._command(f"command/aux/{aux_id}")
 
     async def clear_alarm(self) -> dict[str, Any]:
         """Clear alarm."""
-        return await self._request("command/clear_alarm", method=METH_POST)
+        return await self._command("command/clear_alarm")
 
     async def set_valve_position(self, position: int) -> dict[str, Any]:
         """Set valve in a certain position."""
-        return await self._request("command/valve/{position}", method=METH_POST)
+        return await self._command(f"command/valve/{position}")
+
+    async def _command(self, uri: str) -> dict[str, Any]:
+        """Send a command to the PoolCop, invalidating the cached status."""
+        try:
+            return await self._request(uri, method=METH_POST)
+        finally:
+            self._status_cache = None
+            self._status_generation += 1
 
     async def close(self) -> None:
-        """Close open client session."""
-        if self.session and self._close_session:
+        """Close the client session, or release the shared default session."""
+        if self._refresh_task is not None and not self._refresh_task.done():
+            self._refresh_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refresh_task
+        if self.session and self._release_session:
+            session, self.session = self.session, None
+            self._release_session = False
+            await release_default_session(session)
+        elif self.session and self._close_session:
             await self.session.close()
             self.session = None
 